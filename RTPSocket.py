@@ -1,10 +1,12 @@
 import socket
 from Queue import Queue, Empty
-from collections import OrderedDict
+from collections import deque
+from itertools import count
 from threading import Thread, Lock
 from hashlib import md5
-from time import sleep
-from datetime import datetime, timedelta
+from binascii import hexlify, unhexlify
+from time import sleep, time
+from rtp_capture import PacketCapture, SENT, RECEIVED
 
 DEBUG_MSG = False
 def log(msg):
@@ -27,19 +29,31 @@ class Colors:
         return color + text + Colors.ENDC
 
 # Handles wrapping payload data with an RTP header, and verifying/computing checksum
-class RTPPacket:
-    HEADER_SIZE = 56
+class RTPPacket(object):
+    HEADER_SIZE = 67
+    MAX_STREAM_ID = 99 # stream_id has two digits in the header
 
+    # Packets sit in the send/receive windows in large numbers, so skip the per-instance __dict__
+    __slots__ = ('payload', 'is_ack', 'is_handshake', 'is_disconnect', 'is_parity', 'client_info', 'ack_num',
+                 'seq_num', 'stream_id', 'stream_seq', 'timeout', 'sent_time', 'window_size', 'checksum')
+
+    # A parity packet is outside the sequence space: seq_num is the first packet of its FEC group and ack_num is the
+    # number of packets in the group. Data packets also carry their position within their stream, which is what
+    # they are delivered in order of
     def __init__(self, payload='', is_ack=False, is_handshake=False, is_disconnect=False, client_info=None,
-                 seq_num=0, ack_num=0, timeout=None, window_size=None):
+                 seq_num=0, ack_num=0, timeout=None, window_size=None, is_parity=False, stream_id=0, stream_seq=0):
         self.payload = payload
         self.is_ack = is_ack
         self.is_handshake = is_handshake
         self.is_disconnect = is_disconnect
+        self.is_parity = is_parity
         self.client_info = client_info
         self.ack_num = ack_num
         self.seq_num = seq_num
+        self.stream_id = stream_id
+        self.stream_seq = stream_seq
         self.timeout = timeout
+        self.sent_time = None # time of first transmission, cleared on resend so it is never used as an RTT sample
         self.window_size = window_size
         self.compute_checksum()
 
@@ -60,9 +74,6 @@ class RTPPacket:
         self.window_size = window_size
         self.compute_checksum()
 
-    def is_expired(self):
-        return datetime.now() > self.timeout
-
     def compute_checksum(self):
         self.checksum = md5(self.serialize(checksum_filled=False)).hexdigest()
 
@@ -78,13 +89,20 @@ class RTPPacket:
     def is_connect(self):
         return self.is_handshake
 
+    # Plain application data, which is what FEC groups are made of
+    def is_data(self):
+        return not (self.is_handshake or self.is_disconnect or self.is_parity)
+
     def serialize(self, checksum_filled=True):
         result = ''
         result += bool_str(self.is_ack)
         result += bool_str(self.is_handshake)
         result += bool_str(self.is_disconnect)
+        result += bool_str(self.is_parity)
         result += str(self.seq_num).zfill(8)
         result += str(self.ack_num).zfill(8)
+        result += str(self.stream_id).zfill(2)
+        result += str(self.stream_seq).zfill(8)
         result += str(self.window_size).zfill(5)
         result += self.checksum if checksum_filled else ('0' * 32)
         result += self.payload
@@ -98,8 +116,10 @@ class RTPPacket:
         if self.is_ack: result += Colors.wrap('ACK', Colors.OKGREEN)
         if self.is_handshake: result += Colors.wrap('SYN', Colors.OKGREEN)
         if self.is_disconnect: result += Colors.wrap('FIN', Colors.FAIL)
+        if self.is_parity: result += Colors.wrap('PAR x' + str(self.ack_num), Colors.HEADER)
         if self.seq_num > 0: result += Colors.wrap('Seq: ' + str(self.seq_num), Colors.OKBLUE)
         if self.is_ack: result += Colors.wrap('Ack: ' + str(self.ack_num), Colors.OKBLUE)
+        if self.stream_seq > 0: result += Colors.wrap('Stream: ' + str(self.stream_id) + '/' + str(self.stream_seq), Colors.OKBLUE)
         result += Colors.wrap('Win: ' + str(self.window_size), Colors.OKBLUE)
         result += (self.payload[:45] + '..') if len(self.payload) > 45 else self.payload
         return result
@@ -112,14 +132,17 @@ class RTPPacket:
         is_ack = str_bool(data[0])
         is_handshake = str_bool(data[1])
         is_disconnect = str_bool(data[2])
-        seq_num = int(data[3:11])
-        ack_num = int(data[11:19])
-        window_size = int(data[19:24])
-        checksum = data[24:56]
-        payload = data[56:] if len(data) > 56 else ''
+        is_parity = str_bool(data[3])
+        seq_num = int(data[4:12])
+        ack_num = int(data[12:20])
+        stream_id = int(data[20:22])
+        stream_seq = int(data[22:30])
+        window_size = int(data[30:35])
+        checksum = data[35:67]
+        payload = data[67:] if len(data) > 67 else ''
 
         pkt_result = cls(payload, is_ack, is_handshake, is_disconnect, client_info, seq_num=seq_num, ack_num=ack_num,
-                         window_size=window_size)
+                         window_size=window_size, is_parity=is_parity, stream_id=stream_id, stream_seq=stream_seq)
 
         result = pkt_result if checksum == pkt_result.checksum else None
 
@@ -132,19 +155,170 @@ class RTPPacket:
 def split_data(data, split_size):
     return [data[i:i+split_size] for i in range(0, len(data), split_size)]
 
+def check_stream_id(stream):
+    if not 0 <= stream <= RTPPacket.MAX_STREAM_ID:
+        raise ValueError('Stream ' + str(stream) + ' is outside 0-' + str(RTPPacket.MAX_STREAM_ID))
+
 def bool_str(bool):
     return 'T' if bool else 'F'
 
 def str_bool(str):
     return str == 'T'
 
+# Interpret a string as a big integer after zero-padding it to size bytes, so that strings can be XORed cheaply
+def str_long(data, size):
+    return int(hexlify(data.ljust(size, '\0')), 16)
+
+def long_str(value, size):
+    return unhexlify('%0*x' % (size * 2, value))
+
+# Prefix a payload with its stream position and length, so that both survive being XORed into a parity packet
+def fec_encode(pkt):
+    return str(pkt.stream_id).zfill(2) + str(pkt.stream_seq).zfill(8) + str(len(pkt.payload)).zfill(4) + pkt.payload
+
+def fec_decode(block, seq_num):
+    length = int(block[10:14])
+    return RTPPacket(block[14:14 + length], seq_num=seq_num, stream_id=int(block[:2]), stream_seq=int(block[2:10]))
+
+# Fixed-capacity circular buffer of packets indexed by seq_num % capacity. Used for the send and receive windows,
+# which only ever hold a contiguous range of sequence numbers no larger than the window size, so a slot that is still
+# taken by another packet means that range was overrun
+class PacketRing(object):
+    __slots__ = ('_capacity', '_seqs', '_pkts', '_count')
+
+    def __init__(self, capacity):
+        self._capacity = max(capacity, 1)
+        self._seqs = [0] * self._capacity
+        self._pkts = [None] * self._capacity
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, seq_num):
+        i = seq_num % self._capacity
+        return self._pkts[i] is not None and self._seqs[i] == seq_num
+
+    def get(self, seq_num):
+        i = seq_num % self._capacity
+        return self._pkts[i] if self._seqs[i] == seq_num else None
+
+    def put(self, seq_num, pkt):
+        i = seq_num % self._capacity
+        if self._pkts[i] is not None and self._seqs[i] != seq_num:
+            raise ValueError('Slot for ' + str(seq_num) + ' still holds ' + str(self._seqs[i]))
+
+        self.overwrite(seq_num, pkt)
+
+    # Store a packet even if its slot holds an older one, for rings kept as a sliding history
+    def overwrite(self, seq_num, pkt):
+        i = seq_num % self._capacity
+        if self._pkts[i] is None:
+            self._count += 1
+        self._seqs[i] = seq_num
+        self._pkts[i] = pkt
+
+    def pop(self, seq_num):
+        i = seq_num % self._capacity
+        pkt = self._pkts[i]
+        if pkt is None or self._seqs[i] != seq_num:
+            return None
+
+        self._pkts[i] = None
+        self._count -= 1
+        return pkt
+
+    # Grow the ring (never shrinks) so that it can hold a window of the given size
+    def ensure_capacity(self, capacity):
+        if capacity <= self._capacity:
+            return
+
+        entries = [(seq, pkt) for seq, pkt in zip(self._seqs, self._pkts) if pkt is not None]
+        self.__init__(capacity)
+        for seq, pkt in entries:
+            self.put(seq, pkt)
+
+# One ordered stream within a connection. Its packets are delivered in stream_seq order independently of the other
+# streams, so a loss in one stream never holds up another
+class ReceiveStream(object):
+    __slots__ = ('next_seq', 'staging', 'packets', 'drained_bytes')
+
+    def __init__(self, capacity):
+        self.next_seq = 1
+        self.staging = PacketRing(capacity) # received ahead of a gap in this stream, stored by stream_seq
+        self.packets = Queue() # in order and final, ready to be used by upper level
+        self.drained_bytes = 0 # payload bytes taken by the upper level so far
+
+# Token bucket used to pace transmissions. Tokens are bytes and refill at `rate` bytes per second. Data and resends
+# only go out while the bucket isn't in debt, so a packet is never held back only because it is larger than the
+# remaining tokens. Dedicated ACKs are never held back, so debt is capped at one packet to keep them from starving data
+class TokenBucket(object):
+    # How much unused send time may be saved up, in seconds, so the transfer loop's granularity doesn't cap the rate
+    BURST_TIME = 0.02
+
+    def __init__(self, rate=0, clock=time):
+        self.rate = rate
+        self.tokens = 0
+        self.clock = clock
+        self.last_refill = clock()
+
+    def _refill(self):
+        now = self.clock()
+        capacity = max(self.rate * TokenBucket.BURST_TIME, RTPSocket.MTU_SIZE)
+        self.tokens = min(capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def can_send(self):
+        self._refill()
+        return self.tokens >= 0
+
+    def consume(self, size):
+        self.tokens = max(self.tokens - size, -RTPSocket.MTU_SIZE)
+
+# Packets waiting to be sent, in one FIFO queue per stream. The next packet comes from the highest priority stream
+# with anything waiting (the earliest queued breaks ties), so changing a stream's priority never reorders the stream
+# itself. Safe to use from the application and transfer threads at once
+class SendQueue(object):
+    def __init__(self, priorities):
+        self.priorities = priorities # priority by stream_id (default 0), read each time a packet is picked
+        self._streams = {} # deque of (order, packet) by stream_id, for streams with packets waiting
+        self._order = count()
+        self._lock = Lock()
+
+    def put(self, pkt):
+        self._lock.acquire()
+        self._streams.setdefault(pkt.stream_id, deque()).append((next(self._order), pkt))
+        self._lock.release()
+
+    # Raises Empty if there is nothing to send, like Queue.get_nowait
+    def get_nowait(self):
+        self._lock.acquire()
+        try:
+            if not self._streams:
+                raise Empty()
+
+            stream_id = max(self._streams, key=lambda stream_id: (self.priorities.get(stream_id, 0),
+                                                                  -self._streams[stream_id][0][0]))
+            packets = self._streams[stream_id]
+            pkt = packets.popleft()[1]
+            if not packets:
+                del self._streams[stream_id]
+
+            return pkt
+        finally:
+            self._lock.release()
+
+    def empty(self):
+        return not self._streams
+
 # Light wrapper around RTPSocketPipeline that deals with data at the bytestream level of abstraction
 class RTPSocket(object):
     MTU_SIZE = 1000
 
-    def __init__(self, port):
+    # reuse_port lets several processes bind the same port, with the kernel spreading flows across them
+    def __init__(self, port, reuse_port=False):
         # Pipeline threads for updating send/receive buffers using UDP socket info
-        self._pipeline = RTPSocketPipeline(port, self)
+        self._pipeline = RTPSocketPipeline(port, self, reuse_port)
         self._pipeline.start()
 
     # Wait for a connection from a client (blocking)
@@ -162,36 +336,96 @@ class RTPSocket(object):
     def disconnect(self):
         self._pipeline.disconnect()
 
+    # Get ready to accept() the next client once the connection has ended (blocking)
+    def reset(self):
+        self._pipeline.restart()
+
     # Close the RTP socket connection (non-blocking)
     def close(self):
         self._pipeline.stop()
 
-    # Send data to the other side (non-blocking)
-    def send(self, data):
-        for chunk in split_data(data, RTPSocket.MTU_SIZE - RTPPacket.HEADER_SIZE):
-            self._pipeline.enqueue_packet_to_send(RTPPacket(chunk))
+    # Send data to the other side on one of the connection's independent ordered streams (non-blocking)
+    def send(self, data, stream=0):
+        check_stream_id(stream)
+        for chunk in split_data(data, self._pipeline.max_payload_size()):
+            self._pipeline.enqueue_packet_to_send(RTPPacket(chunk, stream_id=stream))
 
-    # Receive data from the other side (blocking)
-    def receive(self):
-        pkt = self._pipeline.dequeue_packet()
+    # Receive data from the other side on one stream (blocking)
+    def receive(self, stream=0):
+        pkt = self._pipeline.dequeue_packet(stream)
         msg = None if pkt is None else pkt.payload
 
         return msg
 
+    # Packets on higher priority streams are sent before any queued on lower priority ones (default 0)
+    def set_stream_priority(self, stream, priority):
+        self._pipeline.set_stream_priority(stream, priority)
+
+    # Fix the receive window at window_size packets, turning off auto-tuning
     def set_window_size(self, window_size):
         self._pipeline.set_window_size(window_size)
 
+    # Size the receive window automatically from the RTT and how fast data is being received (on by default)
+    def set_window_auto_tuning(self, enabled):
+        self._pipeline.set_window_auto_tuning(enabled)
+
+    # Cap the send rate in bytes per second (None to remove the cap)
+    def set_send_rate(self, rate):
+        self._pipeline.set_send_rate(rate)
+
+    # Spread transmissions evenly over the RTT instead of sending a window's worth at once
+    def set_pacing(self, enabled):
+        self._pipeline.set_pacing(enabled)
+
+    # Ask for forward error correction: a parity packet after every group_size data packets. Must be called before
+    # connect(), since it is negotiated during the handshake. With adaptive, the group size follows the loss rate
+    def set_fec(self, group_size, adaptive=False):
+        self._pipeline.set_fec(group_size, adaptive)
+
+    # Record every datagram sent and received to a capture file, for offline replay with rtp-replay.py
+    def start_capture(self, filename):
+        self._pipeline.start_capture(filename)
+
+    def stop_capture(self):
+        self._pipeline.stop_capture()
+
 
 # Bulk of the RTP protocol code. Handles data at the packet level of abstraction. Ensures reliable delivery
 # to the other side and handles connection management
 class RTPSocketPipeline(object):
     PACKET_TIMEOUT = 1
 
-    def __init__(self, port, rtp_socket):
+    # Window rings are sized with slack so that in-flight packets never collide when the window changes size
+    RING_SLACK = 2
+
+    # Receive window auto-tuning bounds, in packets and bytes of buffered data, and how often it is re-evaluated
+    AUTO_WINDOW_MIN = 10
+    AUTO_WINDOW_MAX_BYTES = 4 * 1024 * 1024
+    AUTO_WINDOW_MIN_INTERVAL = 0.1
+
+    # FEC group size limits, and the prefix fec_encode adds to each data payload before it is XORed into a parity packet
+    FEC_MIN_GROUP = 2
+    FEC_MAX_GROUP = 64
+    # How long a group smaller than FEC_MIN_GROUP waits for more data before its parity is sent anyway, in seconds
+    FEC_FLUSH_DELAY = 0.05
+    FEC_PREFIX_SIZE = 14
+    FEC_BLOCK_SIZE = RTPSocket.MTU_SIZE - RTPPacket.HEADER_SIZE
+
+    # udp_sock replaces the pipeline's own UDP socket when given, e.g. to feed it datagrams from a capture or a
+    # simulated network. It only needs recvfrom (raising socket.timeout when there is nothing to receive), sendto,
+    # settimeout and close. clock returns the current time in seconds, and can be swapped for a virtual one
+    def __init__(self, port, rtp_socket, reuse_port=False, udp_sock=None, clock=time):
         self.running = False
+        self.clock = clock
         self.rtp_sock = rtp_socket
-        self.send_window_size = 10
-        self.receive_window_size = 10
+        self._capture = None
+        self.receive_window_size = RTPSocketPipeline.AUTO_WINDOW_MIN
+        self.window_auto_tuning = True
+        self.send_rate = None
+        self.pacing = False
+        self.fec_group_size = 0
+        self.fec_adaptive = False
+        self.stream_priorities = {}
         self.reset_connection()
 
         # For thread control
@@ -199,12 +433,21 @@ class RTPSocketPipeline(object):
         self.send_base_lock = Lock()
 
         # Internal UDP Socket initialization
+        if udp_sock is not None:
+            self.udp_sock = udp_sock
+            return
+
         self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            self.udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.udp_sock.bind(('', port))
         self.udp_sock.settimeout(.01)
 
     # Initialize our RTP connection data structures and variables
     def reset_connection(self):
+        self.send_window_size = 10
+        if self.window_auto_tuning:
+            self.receive_window_size = RTPSocketPipeline.AUTO_WINDOW_MIN
         self.connected = False
         self.handshaking = False
         self.received_part_1 = False
@@ -212,15 +455,31 @@ class RTPSocketPipeline(object):
         self.other_addr = None
         self.other_port = None
         self.kill_time = None
+        self.send_window_full = False
         self.next_seq_num = 1
         self.send_base = 1
         self.rcv_base = 1
         self.part_2_expected_syn_ack = None
         self.part_3_expected_ack = None
-        self._send_packets = Queue() # input packets sent to the pipeline to transmit reliably to other side
-        self._pending_ack_packets = OrderedDict() # packets that were went but not yet acknowledged
-        self._receive_packets_staging = {} # buffered packets that were received out of order, stored by seq_num
-        self._receive_packets = Queue() # in order and final, ready to be used by upper level
+        self._next_resend_time = 0 # earliest timeout of any packet pending an ACK
+        self.srtt = None # smoothed round trip time, in seconds
+        self._send_bucket = TokenBucket(clock=self.clock)
+        self.loss_rate = 0.0 # fraction of transmissions that were resends
+        self.resend_count = 0
+        self.drain_rate = None # bytes per second taken by the upper level, for receive window auto-tuning
+        self._drain_sample_time = self.clock()
+        self._drain_sample_bytes = 0
+        self._fec_group_base = None # first seq_num of the FEC group being sent
+        self._fec_group_count = 0
+        self._fec_group_parity = 0
+        self._fec_group_time = None # when the last packet joined the FEC group being sent
+        self._fec_parities = {} # parity packets received but not yet used, stored by group base seq_num
+        self._delivered_packets = PacketRing(RTPSocketPipeline.FEC_MAX_GROUP * self.RING_SLACK) # needed to rebuild
+        self._send_packets = SendQueue(self.stream_priorities) # input packets to transmit reliably to other side
+        self._send_stream_seqs = {} # next stream_seq to hand out, by stream_id
+        self._pending_ack_packets = PacketRing(self.send_window_size * self.RING_SLACK) # sent but not yet acknowledged
+        self._receive_packets_staging = PacketRing(self.receive_window_size * self.RING_SLACK) # received out of order
+        self._receive_streams = {} # ReceiveStream by stream_id
         self._queued_ack_numbers = Queue() # ACK nums that need to be carried to the other side
         self._urgent_send_packets = Queue()
 
@@ -233,11 +492,19 @@ class RTPSocketPipeline(object):
         self.transfer_thread = Thread(target=self._run_transfer, name='TransferThread')
         self.transfer_thread.start()
 
+    # Get ready for a new connection once the last one has ended. The UDP socket (and so its port binding) is kept
+    def restart(self):
+        self.running = False
+        self.transfer_thread.join()
+        self.reset_connection()
+        self.start()
+
     def stop(self):
         self.connected = False
         self.running = False
         self.transfer_thread.join()
         self.udp_sock.close()
+        self.stop_capture()
 
     def await_connection(self):
         while not self.connected:
@@ -246,71 +513,204 @@ class RTPSocketPipeline(object):
         log('\n' + Colors.wrap('Connected. Receive Base: ' + str(self.rcv_base), Colors.OKGREEN) + '\n')
 
     def connect(self, address, port):
-        self.update_client_info(address, port)
-        self.enqueue_packet_to_send(RTPPacket(is_handshake=True))
+        self.begin_connect(address, port)
         self.await_connection()
 
+    # Start the handshake without waiting for it to finish
+    def begin_connect(self, address, port):
+        self.update_client_info(address, port)
+        self.enqueue_packet_to_send(RTPPacket(self._fec_handshake_payload(), is_handshake=True))
+
     def disconnect(self):
         self._urgent_send_packets.put(RTPPacket(is_disconnect=True))
         while self.connected:
             sleep(1)
 
     def enqueue_packet_to_send(self, pkt):
+        # Number data packets within their stream in the order the application sent them
+        if pkt.is_data():
+            pkt.stream_seq = next(self._send_stream_seqs.setdefault(pkt.stream_id, count(1)))
+
         self._send_packets.put(pkt)
 
     def set_window_size(self, window_size):
+        self.window_auto_tuning = False
         self.receive_window_size = window_size
 
-    def has_packet(self):
-        return not self._receive_packets.empty()
+    def set_window_auto_tuning(self, enabled):
+        self.window_auto_tuning = enabled
+
+    def set_send_rate(self, rate):
+        self.send_rate = rate
+
+    def set_pacing(self, enabled):
+        self.pacing = enabled
+
+    def set_fec(self, group_size, adaptive=False):
+        self.fec_group_size = group_size
+        self.fec_adaptive = adaptive
+
+    # FEC is negotiated in the SYN payload: the group size, with an 'a' suffix when it should adapt to the loss rate.
+    # Both sides need it, since either one can end up being the bulk sender
+    def _fec_handshake_payload(self):
+        if not self.fec_group_size:
+            return ''
+        return str(self.fec_group_size) + ('a' if self.fec_adaptive else '')
+
+    def _apply_fec_handshake_payload(self, payload):
+        self.fec_adaptive = payload.endswith('a')
+        self.fec_group_size = int(payload.rstrip('a')) if payload else 0
+
+    def set_stream_priority(self, stream, priority):
+        check_stream_id(stream)
+        self.stream_priorities[stream] = priority
+
+    def start_capture(self, filename):
+        self.stop_capture()
+        self._capture = PacketCapture(filename, self.clock)
+
+    def stop_capture(self):
+        capture = self._capture
+        self._capture = None
+        if capture is not None:
+            capture.close()
+
+    # Largest data payload that fits in one packet, leaving room for the FEC length prefix if FEC is in use
+    def max_payload_size(self):
+        size = RTPSocket.MTU_SIZE - RTPPacket.HEADER_SIZE
+        return size - RTPSocketPipeline.FEC_PREFIX_SIZE if self.fec_group_size else size
+
+    def _get_receive_stream(self, stream_id):
+        stream = self._receive_streams.get(stream_id)
+        if stream is None:
+            # Both the application and transfer threads can get here first
+            stream = self._receive_streams.setdefault(stream_id, ReceiveStream(self.receive_window_size * self.RING_SLACK))
+        return stream
+
+    def has_packet(self, stream=0):
+        return not self._get_receive_stream(stream).packets.empty()
 
     def print_debug(self):
         log('\n\nReceive base: ' + str(self.rcv_base) + '; Send Base: ' + str(self.send_base) + '; Next Seq: ' + str(self.next_seq_num))
-        log('Receive window: ' + str(self.receive_window_size) + '; Send window: ' + str(self.send_window_size) + '\n')
+        log('Receive window: ' + str(self.receive_window_size) + '; Send window: ' + str(self.send_window_size))
+        log('SRTT: ' + str(self.srtt) + '; Send rate: ' + str(self._get_send_rate()))
+        log('Loss rate: ' + str(self.loss_rate) + '; FEC group size: ' + str(self.fec_group_size))
+        log('Drain rate: ' + str(self.drain_rate) + '; Window auto-tuning: ' + str(self.window_auto_tuning) + '\n')
+
+    def dequeue_packet(self, stream=0):
+        receive_stream = self._get_receive_stream(stream)
+        pkt = None
 
-    def dequeue_packet(self):
         while self.running and self.connected:
             try:
-                return self._receive_packets.get(timeout=1)
+                pkt = receive_stream.packets.get(timeout=1)
+                break
             except Empty:
                 continue
 
-        if not self._receive_packets.empty():
-            return self._receive_packets.get()
+        if pkt is None and not receive_stream.packets.empty():
+            pkt = receive_stream.packets.get()
+
+        if pkt is not None:
+            receive_stream.drained_bytes += len(pkt.payload)
+
+        return pkt
+
+    # Take the next in-order packet from a stream if there is one (non-blocking)
+    def poll_packet(self, stream=0):
+        receive_stream = self._get_receive_stream(stream)
+        try:
+            pkt = receive_stream.packets.get_nowait()
+        except Empty:
+            return None
+
+        receive_stream.drained_bytes += len(pkt.payload)
+        return pkt
+
+    # Run the transfer loop until there is nothing more it can do right now. For callers that drive the pipeline
+    # themselves (with an injected clock and socket) instead of starting its thread
+    def step(self):
+        while self._transfer_step() or not self._queued_ack_numbers.empty():
+            pass
+
+    # When step() next has to run even if no datagram arrives, or None if nothing is waiting on a timer
+    def next_timer_due(self):
+        now = self.clock()
+
+        # Paced data held back until the bucket refills
+        if self._send_bucket.rate and not self._send_packets.empty():
+            return now
+
+        due = []
+        if len(self._pending_ack_packets):
+            due.append(max(self._next_resend_time, now))
+        if self._fec_group_count:
+            due.append(max(self._fec_group_time + RTPSocketPipeline.FEC_FLUSH_DELAY, now))
+        return min(due) if due else None
 
     # Thread that handles sending and receiving from the underlying socket, and associated processing
     def _run_transfer(self):
         while self.running:
-            self._receive_and_process_packets()
-            self._send_pending_packets()
-            self._check_timers()
+            self._transfer_step()
+
+    # One pass of the transfer loop. Returns whether a datagram was received
+    def _transfer_step(self):
+        received = self._receive_and_process_packets()
+        # Resends go first, so that new data can't use up the pacing rate ahead of them
+        self._check_timers()
+        self._send_pending_packets()
+        self._tune_receive_window()
 
-            if self.kill_time is not None and datetime.now() > self.kill_time:
-                self.connected = False
-                self.running = False
+        if self.kill_time is not None and self.clock() > self.kill_time:
+            self.connected = False
+            self.running = False
+
+        return received
 
     def _check_timers(self):
+        # Nothing can have expired yet, so skip walking the window
+        now = self.clock()
+        if now < self._next_resend_time:
+            return
+
         self._pending_ack_packets_lock.acquire()
 
-        oldest_seq = self._get_oldest_seq()
-        while oldest_seq is not None and self.in_send_window(oldest_seq) and self._pending_ack_packets[oldest_seq].is_expired():
-            # Resend it
-            log(Colors.wraps('RESEND: [' + str(oldest_seq) + ']', Colors.WARNING))
-            pkt = self._pending_ack_packets[oldest_seq]
-            self._send_packet(pkt, lock=False)
+        next_resend_time = now + RTPSocketPipeline.PACKET_TIMEOUT
+        for seq_num in xrange(self.send_base, min(self.next_seq_num, self.send_base + self.send_window_size)):
+            pkt = self._pending_ack_packets.get(seq_num)
+            if pkt is None:
+                continue
+
+            if pkt.timeout < now:
+                # Pace resends like new data, so a whole expired window doesn't go out back-to-back. Whatever is
+                # left over is resent on a later pass
+                if self._send_bucket.rate and not self._send_bucket.can_send():
+                    next_resend_time = now
+                    break
 
-            # Move to the end of the line
-            del self._pending_ack_packets[oldest_seq]
-            self._pending_ack_packets[oldest_seq] = pkt
+                # Resend it
+                log(Colors.wraps('RESEND: [' + str(seq_num) + ']', Colors.WARNING))
+                pkt.sent_time = None
+                self._send_packet(pkt, lock=False)
+                self.resend_count += 1
+                self._update_loss_rate(True)
 
-            # Try the next oldest
-            oldest_seq = self._get_oldest_seq()
+            next_resend_time = min(next_resend_time, pkt.timeout)
 
+        self._next_resend_time = next_resend_time
         self._pending_ack_packets_lock.release()
 
     def _receive_and_process_packets(self):
         try:
             data, addr = self.udp_sock.recvfrom(RTPSocket.MTU_SIZE)
+            capture = self._capture # read once, as it can be stopped from another thread
+            if capture is not None:
+                capture.record(RECEIVED, data)
+
+            # Once a client is accepted, ignore anyone else that hashed onto this socket
+            if self.received_part_1 and addr != (self.other_addr, self.other_port):
+                return True
+
             pkt = RTPPacket.deserialize_and_create(data, addr)
 
             # Don't proceed if the checksum was invalid
@@ -319,13 +719,17 @@ class RTPSocketPipeline(object):
 
             log('R: (' + pkt.debug_str() + ')')
 
+            # Until a client connects there is nobody to answer, e.g. for stragglers from a connection that has ended
+            if self.other_addr is None and not pkt.is_connect_part_1():
+                return True
+
             # Watch for disconnect
             if pkt.is_disconnect:
                 if pkt.is_ack:
                     self.connected = False
                     return
                 else:
-                    self.kill_time = datetime.now() + timedelta(seconds=7)
+                    self.kill_time = self.clock() + 7
                     self._send_packet(RTPPacket(is_disconnect=True, is_ack=True, seq_num=self.next_seq_num))
                     self.next_seq_num += 1
 
@@ -337,15 +741,24 @@ class RTPSocketPipeline(object):
             if self.send_window_size != pkt.window_size:
                 self._update_send_window(pkt.window_size)
 
-            # SENDER-side stuff (Receive ACKs for things we sent and adjust send window accordingly)
-            if pkt.is_ack and self.in_send_window(pkt.ack_num):
+            # Parity packets are outside the sequence space, so they are never ACKed
+            if pkt.is_parity:
+                self._process_parity_packet(pkt)
+                return True
+
+            # SENDER-side stuff (Receive ACKs for things we sent and adjust send window accordingly). Accept ACKs for
+            # anything outstanding, since the peer may have shrunk its window since we sent it
+            if pkt.is_ack and self.send_base <= pkt.ack_num < self.next_seq_num:
                 self._pending_ack_packets_lock.acquire()
 
                 # Mark that packet as received, if it's still there
-                if pkt.ack_num in self._pending_ack_packets:
-                    del self._pending_ack_packets[pkt.ack_num]
+                acked_pkt = self._pending_ack_packets.pop(pkt.ack_num)
+                if acked_pkt is not None:
                     self._pending_ack_packets_lock.release()
 
+                    if acked_pkt.sent_time is not None:
+                        self._update_rtt(self.clock() - acked_pkt.sent_time)
+
                     # If this packet was the previous window base, we need to move it forward some amount
                     if self.send_base == pkt.ack_num:
                         self._move_send_window()
@@ -354,8 +767,9 @@ class RTPSocketPipeline(object):
 
             # RECEIVER-side stuff (Accept incoming data and send ACKs to the other side for it)
             if pkt.has_non_ack_info():
-                if self.rcv_base - self.receive_window_size <= pkt.seq_num < self.rcv_base:
-                    # Need to resend an ACK for this one, but no further actions
+                if pkt.seq_num < self.rcv_base:
+                    # Need to resend an ACK for this one, but no further actions. This has to cover everything below
+                    # the base, as the sender may still be retransmitting from before the window shrank
                     log(Colors.wraps('QUEUE Ack (Duplicate) [' + str(pkt.seq_num) + ']', Colors.WARNING))
                     self._queued_ack_numbers.put(pkt.seq_num)
                 elif self.rcv_base <= pkt.seq_num < self.rcv_base + self.receive_window_size:
@@ -363,17 +777,12 @@ class RTPSocketPipeline(object):
                     self._stage_packet(pkt)
                 else:
                     log(Colors.wrap('[Received out of range packet. Window Base: ' + str(self.rcv_base) + '; this seq: ' + str(pkt.seq_num) + '*', Colors.WARNING))
-            else:
-                self._stage_packet(pkt)
 
         except socket.timeout:
             return False
 
         return True
 
-    def in_send_window(self, num):
-        return self.send_base <= num < self.send_base + self.send_window_size
-
     # Perform actions when receiving a connection handshake packet
     def _process_handshake_packet(self, pkt):
         # Server receives PART 1
@@ -383,8 +792,11 @@ class RTPSocketPipeline(object):
                 self._update_rcv_base(pkt.seq_num + 1)
                 self.update_client_info(pkt.client_info[0], pkt.client_info[1])
 
+                # The client asks for FEC in the SYN payload, and we agree by echoing it back
+                self._apply_fec_handshake_payload(pkt.payload)
+
                 # Send part 2 (the SYN/ACK)
-                self.enqueue_packet_to_send(RTPPacket(is_ack=True, ack_num=pkt.seq_num, is_handshake=True))
+                self.enqueue_packet_to_send(RTPPacket(pkt.payload, is_ack=True, ack_num=pkt.seq_num, is_handshake=True))
 
             return True
 
@@ -392,11 +804,14 @@ class RTPSocketPipeline(object):
         if pkt.is_connect_part_2():
             if not self.received_part_2:
                 self.received_part_2 = True
+                self._apply_fec_handshake_payload(pkt.payload)
                 self.connected = True
                 self._update_rcv_base(pkt.seq_num + 1)
 
-                # Mark Part1 as received
-                del self._pending_ack_packets[pkt.ack_num]
+                # Mark Part1 as received, which also gives us our first RTT sample
+                part_1 = self._pending_ack_packets.pop(pkt.ack_num)
+                if part_1 is not None and part_1.sent_time is not None:
+                    self._update_rtt(self.clock() - part_1.sent_time)
                 self._move_send_window()
 
             # Send part 3 (the final ACK) even if we already sent it before
@@ -411,14 +826,160 @@ class RTPSocketPipeline(object):
         return False
 
     def _stage_packet(self, pkt):
+        # The receive window may have been grown from the application thread
+        self._receive_packets_staging.ensure_capacity(self.receive_window_size * self.RING_SLACK)
+
         # Make sure it hasn't already been received before proceeding
         if not pkt.seq_num in self._receive_packets_staging:
-            self._receive_packets_staging[pkt.seq_num] = pkt
+            self._receive_packets_staging.put(pkt.seq_num, pkt)
+
+            if pkt.is_data():
+                self._deliver_to_stream(pkt)
 
             if pkt.seq_num == self.rcv_base:
                 self._unstage_ordered_packets()
 
+            if self._fec_parities:
+                self._recover_lost_packets()
+
+    def _process_parity_packet(self, pkt):
+        # Keep it only if some of its group has yet to be delivered
+        if pkt.seq_num + pkt.ack_num > self.rcv_base and pkt.seq_num < self.rcv_base + self.receive_window_size:
+            self._fec_parities[pkt.seq_num] = pkt
+            self._recover_lost_packets()
+
+    # Rebuild any packet that is the only one missing from a group we have the parity for, without waiting for the
+    # sender to time out and resend it
+    def _recover_lost_packets(self):
+        for base, parity in self._fec_parities.items():
+            # Already used up by a recovery further down the stack
+            if base not in self._fec_parities:
+                continue
+
+            end = base + parity.ack_num
+            missing = [seq for seq in xrange(max(base, self.rcv_base), end) if seq not in self._receive_packets_staging]
+            if len(missing) > 1:
+                continue
+
+            del self._fec_parities[base]
+            if not missing or missing[0] >= self.rcv_base + self.receive_window_size:
+                continue
+
+            # XOR the rest of the group back out of the parity
+            value = str_long(parity.payload, RTPSocketPipeline.FEC_BLOCK_SIZE)
+            for seq in xrange(base, end):
+                if seq == missing[0]:
+                    continue
+
+                member = self._receive_packets_staging.get(seq) if seq >= self.rcv_base else self._delivered_packets.get(seq)
+                if member is None:
+                    # Delivered too long ago to still be around
+                    break
+
+                value ^= str_long(fec_encode(member), RTPSocketPipeline.FEC_BLOCK_SIZE)
+            else:
+                pkt = fec_decode(long_str(value, RTPSocketPipeline.FEC_BLOCK_SIZE), missing[0])
+
+                log(Colors.wraps('RECOVERED: [' + str(pkt.seq_num) + ']', Colors.HEADER))
+                self._queued_ack_numbers.put(pkt.seq_num)
+                self._stage_packet(pkt)
+
+    # Add a packet we just sent for the first time to the current FEC group, sending the parity once the group is full
+    def _add_to_fec_group(self, pkt):
+        if not self.fec_group_size:
+            return
+
+        # Groups are runs of consecutive data packets, so anything else closes the current group
+        if self._fec_group_count and (not pkt.is_data() or pkt.seq_num != self._fec_group_base + self._fec_group_count):
+            self._send_fec_parity()
+
+        if not pkt.is_data():
+            return
+
+        if not self._fec_group_count:
+            self._fec_group_base = pkt.seq_num
+
+        self._fec_group_parity ^= str_long(fec_encode(pkt), RTPSocketPipeline.FEC_BLOCK_SIZE)
+        self._fec_group_count += 1
+        self._fec_group_time = self.clock()
+
+        if self._fec_group_count >= self._get_fec_group_size():
+            self._send_fec_parity()
+
+    # A parity for a group of one doubles its traffic, so small groups (e.g. interactive sends) get a moment to grow
+    def _flush_idle_fec_group(self):
+        if self._fec_group_count and (self._fec_group_count >= RTPSocketPipeline.FEC_MIN_GROUP or
+                                      self.clock() >= self._fec_group_time + RTPSocketPipeline.FEC_FLUSH_DELAY):
+            self._send_fec_parity()
+
+    def _send_fec_parity(self):
+        if self._fec_group_count:
+            payload = long_str(self._fec_group_parity, RTPSocketPipeline.FEC_BLOCK_SIZE).rstrip('\0')
+            pkt = RTPPacket(payload, seq_num=self._fec_group_base, ack_num=self._fec_group_count, is_parity=True)
+            self._send_packet(pkt, pkt_timeout=False)
+
+        self._fec_group_count = 0
+        self._fec_group_parity = 0
+
+    def _get_fec_group_size(self):
+        if not self.fec_adaptive:
+            return self.fec_group_size
+
+        # Aim for about one loss every two groups, so that most losses are the only one in their group
+        size = int(0.5 / self.loss_rate) if self.loss_rate else RTPSocketPipeline.FEC_MAX_GROUP
+        return max(RTPSocketPipeline.FEC_MIN_GROUP, min(RTPSocketPipeline.FEC_MAX_GROUP, size))
+
+    def _update_loss_rate(self, lost):
+        self.loss_rate = 0.99 * self.loss_rate + (0.01 if lost else 0)
+
+    # Advertise room for twice what the upper level drained over the last RTT, so that the window stays ahead of a
+    # reader that keeps up, and halve it whenever the reader falls behind
+    def _tune_receive_window(self):
+        if not self.window_auto_tuning or self.srtt is None:
+            return
+
+        now = self.clock()
+        elapsed = now - self._drain_sample_time
+        if elapsed < max(self.srtt, RTPSocketPipeline.AUTO_WINDOW_MIN_INTERVAL):
+            return
+
+        streams = self._receive_streams.values()
+        drained = sum(stream.drained_bytes for stream in streams)
+        backlog = sum(stream.packets.qsize() for stream in streams)
+        self.drain_rate = (drained - self._drain_sample_bytes) / elapsed
+        self._drain_sample_time = now
+        self._drain_sample_bytes = drained
+
+        if backlog > self.receive_window_size / 2:
+            window = self.receive_window_size / 2
+        else:
+            window = max(self.receive_window_size, int(2 * self.drain_rate * self.srtt / RTPSocket.MTU_SIZE))
+
+        max_window = RTPSocketPipeline.AUTO_WINDOW_MAX_BYTES / RTPSocket.MTU_SIZE
+        window = max(RTPSocketPipeline.AUTO_WINDOW_MIN, min(max_window, window))
+
+        if window != self.receive_window_size:
+            log(Colors.wrap('Receive window: ' + str(window), Colors.OKBLUE))
+            self.receive_window_size = window
+
+    def _update_rtt(self, sample):
+        self.srtt = sample if self.srtt is None else 0.875 * self.srtt + 0.125 * sample
+
+    # Rate (bytes/s) that data packets should be paced at, or None if they can go out as fast as the window allows
+    def _get_send_rate(self):
+        rates = []
+        if self.send_rate:
+            rates.append(self.send_rate)
+        if self.pacing and self.srtt:
+            rates.append(self.send_window_size * RTPSocket.MTU_SIZE / self.srtt)
+
+        return min(rates) if rates else None
+
     def _update_send_window(self, new_value):
+        self._pending_ack_packets_lock.acquire()
+        self._pending_ack_packets.ensure_capacity(new_value * self.RING_SLACK)
+        self._pending_ack_packets_lock.release()
+
         self.send_window_size = new_value
 
     # Try to move the send window forward
@@ -436,18 +997,38 @@ class RTPSocketPipeline(object):
         self.rcv_base = value
         self._unstage_ordered_packets()
 
-    # Try to move as many continuous packets upwards as we can
-    def _unstage_ordered_packets(self):
-        while self.rcv_base in self._receive_packets_staging:
-            # Remove this packet from staging
-            pkt = self._receive_packets_staging[self.rcv_base]
-            del self._receive_packets_staging[self.rcv_base]
+    # Hand a newly received packet to its stream, moving up as many of the stream's continuous packets as we can
+    def _deliver_to_stream(self, pkt):
+        stream = self._get_receive_stream(pkt.stream_id)
+
+        if pkt.stream_seq < stream.next_seq:
+            return
 
+        if pkt.stream_seq > stream.next_seq:
+            stream.staging.ensure_capacity(self.receive_window_size * self.RING_SLACK)
+            stream.staging.put(pkt.stream_seq, pkt)
+            return
+
+        while pkt is not None:
             # Send it upwards
-            self._receive_packets.put(pkt)
+            stream.packets.put(pkt)
+
+            # Move forward in the stream's staging buffer
+            stream.next_seq += 1
+            pkt = stream.staging.pop(stream.next_seq)
+
+    # Move the receive window past as many continuous packets as we can (they were already handed to their streams)
+    def _unstage_ordered_packets(self):
+        # Remove each packet from staging
+        pkt = self._receive_packets_staging.pop(self.rcv_base)
+        while pkt is not None:
+            # Hang on to it in case it is needed to rebuild a later packet in its FEC group
+            if self.fec_group_size:
+                self._delivered_packets.overwrite(self.rcv_base, pkt)
 
             # Move forward in the staging buffer
             self.rcv_base += 1
+            pkt = self._receive_packets_staging.pop(self.rcv_base)
 
     def _send_pending_packets(self):
         self.send_base_lock.acquire()
@@ -455,12 +1036,36 @@ class RTPSocketPipeline(object):
         ack_ferried = False
         any_packet_sent = False
 
-        # Send any outstanding packets
-        if self.next_seq_num < self.send_base + self.send_window_size:
-            self.send_window_full = False
-            try:
-                pkt = self._urgent_send_packets.get() if not self._urgent_send_packets.empty() else self._send_packets.get(timeout=0.01)
+        rate = self._get_send_rate()
+        self._send_bucket.rate = rate or 0
+
+        # Send as many outstanding packets as the window and pacing allow. Never wait on the queue, since the socket's
+        # receive timeout already keeps the transfer loop from spinning
+        try:
+            while True:
+                # Hold data back if the pacing rate has been used up
+                if rate is not None and not self._send_bucket.can_send():
+                    break
+
+                if self.next_seq_num >= self.send_base + self.send_window_size:
+                    if not self.send_window_full:
+                        log(Colors.wrap('*Send window full*', Colors.WARNING))
+                        self.send_window_full = True
+                    break
+
+                self.send_window_full = False
+                try:
+                    if not self._urgent_send_packets.empty():
+                        pkt = self._urgent_send_packets.get()
+                    else:
+                        pkt = self._send_packets.get_nowait()
+                except Empty:
+                    # Nothing more to send for now, so don't hold back the parity for a partial group for long
+                    self._flush_idle_fec_group()
+                    break
+
                 pkt.set_seq_num(self.next_seq_num)
+                pkt.sent_time = self.clock()
 
                 # Try to ferry any ACKs over
                 if not self._queued_ack_numbers.empty():
@@ -470,15 +1075,10 @@ class RTPSocketPipeline(object):
                 self._send_packet(pkt)
                 self.next_seq_num += 1
                 any_packet_sent = True
-            except Empty:
-                pass
-            finally:
-                self.send_base_lock.release()
-        else:
-            if not self.send_window_full:
-                log(Colors.wrap('*Send window full*', Colors.WARNING))
-                self.send_window_full = True
 
+                self._update_loss_rate(False)
+                self._add_to_fec_group(pkt)
+        finally:
             self.send_base_lock.release()
 
         # If no data could ferry the ACK over, send a dedicated ACK message over
@@ -489,15 +1089,13 @@ class RTPSocketPipeline(object):
 
         return any_packet_sent
 
-    def _get_oldest_seq(self):
-        return None if not self._pending_ack_packets else self._pending_ack_packets.iterkeys().next()
-
     def _send_packet(self, pkt, pkt_timeout=True, lock=True):
         if pkt_timeout:
+            pkt.timeout = self.clock() + RTPSocketPipeline.PACKET_TIMEOUT
             if lock: self._pending_ack_packets_lock.acquire()
-            self._pending_ack_packets[pkt.seq_num] = pkt
+            self._pending_ack_packets.put(pkt.seq_num, pkt)
+            self._next_resend_time = min(self._next_resend_time, pkt.timeout)
             if lock: self._pending_ack_packets_lock.release()
-            pkt.timeout = datetime.now() + timedelta(seconds=RTPSocketPipeline.PACKET_TIMEOUT)
 
         # Special record keeping for Syn/Ack and Ack
         if pkt.is_connect_part_2():
@@ -508,5 +1106,13 @@ class RTPSocketPipeline(object):
         # Add on window size to the packet
         pkt.set_window_size(self.receive_window_size)
 
+        data = pkt.serialize()
+        if self._send_bucket.rate:
+            self._send_bucket.consume(len(data))
+
+        capture = self._capture # read once, as it can be stopped from another thread
+        if capture is not None:
+            capture.record(SENT, data)
+
         log('S: (' + pkt.debug_str() + ')')
-        self.udp_sock.sendto(pkt.serialize(), (self.other_addr, self.other_port))
+        self.udp_sock.sendto(data, (self.other_addr, self.other_port))
@@ -15,7 +15,8 @@ import os
 import sys
 import time
 from RTPSocket import RTPSocket
-from fta_util import decodeHeader, HEADER_SIZE, encodeFileHeader, printNetworkStats
+from fta_util import decodeHeader, HEADER_SIZE, encodeFileHeader, printNetworkStats, CONTROL_STREAM, FileWriter, \
+    SYNC_WRITES
 
 if len(sys.argv) != 4:
     print "Entered incorrect number of arguments"
@@ -32,6 +33,7 @@ clientSocket = RTPSocket(int(clientPort))
 
 response = ""
 connected = False
+syncWrites = SYNC_WRITES
 try:
     while True:
         command = raw_input(">")
@@ -43,6 +45,12 @@ try:
             clientSocket.connect(netEmuIp, int(netEmuPort))
             connected = True
             print("Successfully connected to the server")
+        elif command[:3] == "fec" and not connected:
+            if command[4:] == "adaptive":
+                clientSocket.set_fec(8, adaptive=True)
+            else:
+                clientSocket.set_fec(int(command[4:]))
+            print "Set FEC group size to " + command[4:]
         elif not connected:
             print "Must connect before performing any actions"
         elif command[:4] == "post":
@@ -63,7 +71,7 @@ try:
                     response = ''
 
                     while len(response) < HEADER_SIZE:
-                        r = clientSocket.receive()
+                        r = clientSocket.receive(CONTROL_STREAM)
 
                         if r is None:
                             clientSocket.close()
@@ -77,7 +85,7 @@ try:
                         remaining = fileSize + HEADER_SIZE - len(response)
 
                         while remaining > 0:
-                            r = clientSocket.receive()
+                            r = clientSocket.receive(CONTROL_STREAM)
 
                             if r is None:
                                 clientSocket.close()
@@ -117,7 +125,7 @@ try:
             else:
                 print "Downloading file '", filename, "' from server..."
                 error, operation, filename, fileSize = decodeHeader(data)
-                outfile = open(filename, "wr")
+                outfile = FileWriter(filename, fileSize, syncWrites)
                 remaining = fileSize + HEADER_SIZE - len(data)
                 outfile.write(data[HEADER_SIZE:])
                 tick = 0
@@ -146,9 +154,28 @@ try:
                 print "File '" + filename + "' downloaded successfully."
                 totalTime = end-start
                 printNetworkStats(totalTime, len(data)/totalTime)
+        elif command == "window auto":
+            clientSocket.set_window_auto_tuning(True)
+            print "Set window size to auto"
         elif command[:6] == "window":
             clientSocket.set_window_size(int(command[7:]))
             print "Set window size to " + command[7:]
+        elif command[:4] == "rate":
+            rate = int(command[5:])
+            clientSocket.set_send_rate(rate if rate > 0 else None)
+            print "Set send rate to " + command[5:]
+        elif command[:4] == "pace":
+            clientSocket.set_pacing(command[5:] == "on")
+            print "Turned pacing " + command[5:]
+        elif command[:4] == "sync":
+            syncWrites = command[5:] == "on"
+            print "Turned syncing of downloaded files " + command[5:]
+        elif command[:7] == "capture":
+            if command[8:] == "off":
+                clientSocket.stop_capture()
+            else:
+                clientSocket.start_capture(command[8:])
+            print "Capture " + command[8:]
         elif command == "disconnect":
             clientSocket.disconnect()
             print "Disconnecting"
@@ -157,6 +184,12 @@ try:
             print "Error: Unknown command. Please reference command list below:\n\n"\
                   "connect:       Terminates any existing connections and stops the server.\n"\
                   "window [int]:  Takes a integer between x and z which determines the windows size.\n"\
+                  "window auto:   Sizes the window automatically from the link and the reader (the default).\n"\
+                  "rate [int]:    Caps the send rate in bytes per second (0 removes the cap).\n"\
+                  "pace [on|off]: Spreads transmissions evenly over the round trip time.\n"\
+                  "sync [on|off]: Flushes each downloaded file to disk (fsync) before reporting it done.\n"\
+                  "fec [int|adaptive]: Before connecting, sends a parity packet every [int] packets (0 for none).\n"\
+                  "capture [file|off]: Records every datagram to a capture file for rtp-replay.py.\n"\
                   "post [file]:   Upload a file to the server.\n"\
                   "get [file]:    Try to retrieve a file from the server.\n"\
                   "disconnect:    Terminates any existing connections and stops the server.\n"
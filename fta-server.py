@@ -5,9 +5,12 @@ following arguments:
 X: the port number at which the fta-server's UDP socket should bind to (odd number)
 A: the IP address of NetEmu
 P: the UDP port number of NetEmu
+W: (optional) the number of worker processes to shard clients across. Each worker binds port X with SO_REUSEPORT
+   and runs its own RTP stack, so the kernel spreads clients across all cores. Workers keep serving clients until
+   terminated, while without W the server exits once its client disconnects
 
 
-Example: python fta-server X A P
+Example: python fta-server X A P [W]
 
 """
 import os
@@ -15,89 +18,288 @@ import os
 import sys
 import thread
 import time
+from multiprocessing import Process, Queue
+from threading import Event
 from RTPSocket import RTPSocket
-from fta_util import decodeHeader, HEADER_SIZE, encodeFileHeader, encodeMessageHeader
+from fta_util import decodeHeader, HEADER_SIZE, encodeFileHeader, encodeMessageHeader, CONTROL_STREAM, FileWriter, \
+    SYNC_WRITES
 
-def listenForCommands(serverSocket):
+syncWrites = SYNC_WRITES
+
+# Stop serving. A connected client is disconnected first, and serveClients exits once it sees the connection end
+def terminate(serverSocket, stopping):
+    stopping.set()
+    if serverSocket.is_connected():
+        serverSocket.disconnect()
+    else:
+        serverSocket.close()
+        os._exit(0)
+
+# Apply a settings command to the socket. Returns False if the command is not recognized
+def runCommand(serverSocket, command, stopping):
+    global syncWrites
+
+    if command == "terminate":
+        terminate(serverSocket, stopping)
+    elif command == "window auto":
+        serverSocket.set_window_auto_tuning(True)
+        print "Window size set to auto"
+    elif command[:6] == "window":
+        serverSocket.set_window_size(int(command[7:]))
+        print "Window size set to " + command[7:]
+    elif command[:4] == "rate":
+        rate = int(command[5:])
+        serverSocket.set_send_rate(rate if rate > 0 else None)
+        print "Send rate set to " + command[5:]
+    elif command[:4] == "pace":
+        serverSocket.set_pacing(command[5:] == "on")
+        print "Pacing turned " + command[5:]
+    elif command[:4] == "sync":
+        syncWrites = command[5:] == "on"
+        print "Syncing received files turned " + command[5:]
+    elif command[:7] == "capture":
+        if command[8:] == "off":
+            serverSocket.stop_capture()
+        else:
+            serverSocket.start_capture(command[8:])
+        print "Capture " + command[8:]
+    else:
+        return False
+
+    return True
+
+def printCommands():
+    print "Error: Unknown command. Please reference command list below:\n\n"\
+          "terminate:       Terminates any existing connections and stops the server.\n"\
+          "window [int]:    Takes a integer between x and z which determines the windows size\n"\
+          "window auto:     Sizes the window automatically from the link and the reader (the default)\n"\
+          "rate [int]:      Caps the send rate in bytes per second (0 removes the cap)\n"\
+          "pace [on|off]:   Spreads transmissions evenly over the round trip time\n"\
+          "sync [on|off]:   Flushes each received file to disk (fsync) before reporting it complete\n"\
+          "capture [file|off]: Records every datagram to a capture file for rtp-replay.py\n"\
+          "stats:           Prints per-worker transfer stats (worker mode only)"
+
+def listenForCommands(serverSocket, stopping):
+    while True:
+        command = raw_input(">")
+        print "Command: " + command
+
+        if not runCommand(serverSocket, command, stopping):
+            printCommands()
+
+# Serve the connected client's requests until it disconnects, then exit. With keepServing (worker mode), serve clients
+# one after another on the same socket until told to stop instead. The socket stays bound throughout, since re-binding
+# a SO_REUSEPORT socket would move other workers' clients onto the wrong socket
+def serveClients(serverSocket, recordStat, stopping, keepServing=False):
+    serverSocket.set_stream_priority(CONTROL_STREAM, 1)
+
+    while True:
+        serverSocket.accept()
+
+        if not serveRequest(serverSocket, recordStat):
+            print "Client disconnected"
+            if stopping.is_set() or not keepServing:
+                sys.exit(0)
+
+            serverSocket.reset()
+
+# Handle one request from the connected client. Returns False if the client disconnected instead
+def serveRequest(serverSocket, recordStat):
+    data = ""
+
+    while len(data) < HEADER_SIZE:
+        r = serverSocket.receive()
+
+        if r is None:
+            return False
+
+        data += r
+
+    error, operation, filename, fileSize = decodeHeader(data)
+    if operation == "1":
+        # Receiving a file from client (client is POSTing)
+        progress = 0
+        lastUpdate = time.time()
+        outfile = FileWriter(filename, fileSize, syncWrites)
+        remaining = fileSize + HEADER_SIZE - len(data)
+        outfile.write(data[HEADER_SIZE:])
+
+        while remaining > 0:
+            message = serverSocket.receive()
+
+            if message is None:
+                outfile.close()
+                return False
+
+            data += message
+            outfile.write(message)
+            remaining -= len(message)
+            tick = time.time()
+            progress = len(data)/float((fileSize + HEADER_SIZE))
+
+            if tick - lastUpdate > .2:
+                updateMessage = str(int(progress * 100)) + "%"
+                serverSocket.send(encodeMessageHeader(0, "2", len(updateMessage)) + updateMessage, CONTROL_STREAM)
+                lastUpdate = time.time()
+
+        outfile.close()
+        recordStat("files_received", 1)
+        recordStat("bytes_received", fileSize)
+        response = ""
+        serverSocket.send(encodeMessageHeader(0, "0", len(response)) + response, CONTROL_STREAM)
+    else:
+        # Client is requesting a file (client is GETing)
+        if os.path.isfile(filename):
+            infile = open(filename)
+            contents = infile.read()
+            serverSocket.send(encodeFileHeader(0, 1, filename) + contents)
+            infile.close()
+            recordStat("files_sent", 1)
+            recordStat("bytes_sent", len(contents))
+        else:
+            serverSocket.send(encodeFileHeader(1, operation, "") + "")
+
+    return True
+
+# Entry point of a worker process. Commands arrive from the supervisor instead of stdin, and stats are reported back.
+# A worker serves clients until it is terminated
+def runWorker(workerId, port, commands, stats):
+    serverSocket = RTPSocket(port, reuse_port=True)
+    stopping = Event()
+
+    def listenForSupervisor():
+        while True:
+            runCommand(serverSocket, commands.get(), stopping)
+
+    thread.start_new_thread(listenForSupervisor, ())
+
+    try:
+        serveClients(serverSocket, lambda key, amount: stats.put((workerId, key, amount)), stopping, keepServing=True)
+    finally:
+        serverSocket.close()
+
+# Starts the worker processes, restarts any that crash, and gathers their stats
+class Supervisor(object):
+    SHUTDOWN_TIMEOUT = 10
+
+    def __init__(self, port, workerCount):
+        self.port = port
+        self.workerCount = workerCount
+        self.running = False
+        self.workers = [None] * workerCount
+        self.commands = [None] * workerCount
+        self.stats = [{"restarts": 0} for _ in range(workerCount)]
+        self.statsQueue = Queue()
+        self.settings = {} # latest settings command of each kind, so that restarted workers get them too
+
+    def start(self):
+        self.running = True
+        for workerId in range(self.workerCount):
+            self.startWorker(workerId)
+
+        thread.start_new_thread(self.gatherStats, ())
+
+    def startWorker(self, workerId):
+        self.commands[workerId] = Queue()
+        self.workers[workerId] = Process(target=runWorker, name="FTAWorker-" + str(workerId),
+                                         args=(workerId, self.port, self.commands[workerId], self.statsQueue))
+        self.workers[workerId].start()
+
+        for command in self.settings.values():
+            self.commands[workerId].put(self.workerCommand(workerId, command))
+
+    # Each worker needs a capture file of its own, and a restarted worker must not overwrite its predecessor's
+    def workerCommand(self, workerId, command):
+        if command[:7] != "capture" or command[8:] == "off":
+            return command
+
+        restarts = self.stats[workerId]["restarts"]
+        return command + "." + str(workerId) + ("." + str(restarts) if restarts else "")
+
+    # Apply a settings command to all workers, now and whenever one is restarted
+    def configure(self, command):
+        self.settings[command.split(" ")[0]] = command
+        for workerId, commands in enumerate(self.commands):
+            commands.put(self.workerCommand(workerId, command))
+
+    # Workers run until terminated, so one that exited has crashed. Restart it
+    def monitor(self):
+        while self.running:
+            for workerId, worker in enumerate(self.workers):
+                if self.running and not worker.is_alive():
+                    self.stats[workerId]["restarts"] += 1
+                    self.startWorker(workerId)
+            time.sleep(1)
+
+    def gatherStats(self):
+        while True:
+            workerId, key, amount = self.statsQueue.get()
+            self.stats[workerId][key] = self.stats[workerId].get(key, 0) + amount
+
+    def broadcast(self, command):
+        for commands in self.commands:
+            commands.put(command)
+
+    def printStats(self):
+        for workerId, worker in enumerate(self.workers):
+            print "Worker " + str(workerId) + " (pid " + str(worker.pid) + "): " + \
+                  ", ".join(key + "=" + str(value) for key, value in sorted(self.stats[workerId].items()))
+
+    def stop(self):
+        self.running = False
+        self.broadcast("terminate")
+
+        for worker in self.workers:
+            worker.join(Supervisor.SHUTDOWN_TIMEOUT)
+            if worker.is_alive():
+                worker.terminate()
+
+def listenForSupervisorCommands(supervisor):
     while True:
         command = raw_input(">")
         print "Command: " + command
 
-        if command == "terminate":
-            serverSocket.disconnect()
-        elif command[:6] == "window":
-            serverSocket.set_window_size(int(command[7:]))
-            print "Window size set to " + command[7:]
+        if command == "stats":
+            supervisor.printStats()
+        elif command == "terminate":
+            # The main thread stops the workers once it sees this, so that it doesn't exit while they shut down
+            supervisor.running = False
+            break
+        elif command.split(" ")[0] in ("window", "rate", "pace", "sync", "capture"):
+            supervisor.configure(command)
         else:
-            print "Error: Unknown command. Please reference command list below:\n\n"\
-                  "terminate:       Terminates any existing connections and stops the server.\n"\
-                  "window [int]:    Takes a integer between x and z which determines the windows size"
+            printCommands()
 
 FILE_READ_SIZE = 2048
 serverPort = int(sys.argv[1])
 emulatorIP = sys.argv[2]
 emulatorPort = int(sys.argv[3])
+workerCount = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+
+if workerCount > 1:
+    supervisor = Supervisor(serverPort, workerCount)
+    supervisor.start()
+
+    # Background thread to listen for commands
+    thread.start_new_thread(listenForSupervisorCommands, (supervisor,))
+
+    print "Server is up and listening with " + str(workerCount) + " workers\n"
+    try:
+        supervisor.monitor()
+    finally:
+        supervisor.stop()
+        supervisor.printStats()
+    sys.exit(0)
 
 #setup socket
 serverSocket = RTPSocket(serverPort)
+stopping = Event()
 
 # Background thread to listen for commands
-thread.start_new_thread(listenForCommands, (serverSocket,))
+thread.start_new_thread(listenForCommands, (serverSocket, stopping))
 
 print "Server is up and listening\n"
 try:
-    while True:
-        serverSocket.accept()
-        data = ""
-
-        while len(data) < HEADER_SIZE:
-            r = serverSocket.receive()
-
-            if r is None:
-                serverSocket.close()
-                print "Client disconnected"
-                sys.exit(0)
-
-            data += r
-
-        error, operation, filename, fileSize = decodeHeader(data)
-        if operation == "1":
-            # Receiving a file from client (client is POSTing)
-            progress = 0
-            lastUpdate = time.time()
-            outfile = open(filename, "wr")
-            remaining = fileSize + HEADER_SIZE - len(data)
-            outfile.write(data[HEADER_SIZE:])
-
-            while remaining > 0:
-                message = serverSocket.receive()
-
-                if message is None:
-                    print "Client disconnected"
-                    serverSocket.close()
-                    sys.exit(0)
-
-                data += message
-                outfile.write(message)
-                remaining -= len(message)
-                tick = time.time()
-                progress = len(data)/float((fileSize + HEADER_SIZE))
-
-                if tick - lastUpdate > .2:
-                    updateMessage = str(int(progress * 100)) + "%"
-                    serverSocket.send(encodeMessageHeader(0, "2", len(updateMessage)) + updateMessage)
-                    lastUpdate = time.time()
-
-            outfile.close()
-            response = ""
-            serverSocket.send(encodeMessageHeader(0, "0", len(response)) + response)
-        else:
-            # Client is requesting a file (client is GETing)
-            if os.path.isfile(filename):
-                infile = open(filename)
-                serverSocket.send(encodeFileHeader(0, 1, filename) + infile.read())
-                infile.close()
-            else:
-                serverSocket.send(encodeFileHeader(1, operation, "") + "")
+    serveClients(serverSocket, lambda key, amount: None, stopping)
 finally:
     serverSocket.close()
@@ -1,7 +1,18 @@
+import ctypes
+import ctypes.util
 import os
+from Queue import Queue
+from threading import Thread
 
 HEADER_SIZE = 290
 
+# RTP stream for progress and completion messages, so that they never wait behind a lost file data packet (file data
+# travels on the default stream)
+CONTROL_STREAM = 1
+
+# Whether received files are fsynced once they are complete, until changed with the "sync" command
+SYNC_WRITES = False
+
 
 def encodeSize(fileSize):
     encoded = str(fileSize)
@@ -33,6 +44,109 @@ def decodeHeader(header):
     return header[0], header[1], header[2:258].strip(), int(header[258:HEADER_SIZE])
 
 
+# Reserve size bytes on disk for a file up front so that the writes don't have to allocate as they go. Python 2 has no
+# os.posix_fallocate, so go through libc where we can and just skip it elsewhere. Returns whether the space was reserved
+def preallocate(outfile, size):
+    if size <= 0:
+        return False
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"))
+        fallocate = libc.posix_fallocate64
+    except (OSError, AttributeError):
+        return False
+
+    # posix_fallocate reports failure (e.g. a full disk, or a filesystem without support) through its return value
+    if fallocate(outfile.fileno(), ctypes.c_int64(0), ctypes.c_int64(size)) != 0:
+        # It may have reserved part of it, so don't leave a file that looks partly written
+        outfile.truncate(0)
+        return False
+
+    return True
+
+
+# Writes a received file on its own thread, so that disk stalls don't hold up draining the RTP socket. Packets are
+# coalesced into large writes at WRITE_SIZE-aligned offsets. If fewer than size bytes arrive (e.g. the sender
+# disconnected), the file is cut back to what was written so that it doesn't look complete
+class FileWriter(object):
+    WRITE_SIZE = 1024 * 1024
+    QUEUE_SIZE = 4096 # packets that can be waiting on the disk before write() blocks
+
+    def __init__(self, filename, size, sync=False):
+        self.sync = sync
+        self.error = None
+        self.size = size
+        self.written = 0
+        self.outfile = open(filename, "wb")
+        preallocate(self.outfile, size)
+
+        self.chunks = Queue(FileWriter.QUEUE_SIZE)
+        self.thread = Thread(target=self.runWriter, name="FileWriterThread")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, data):
+        if data:
+            self.chunks.put(data)
+
+    # Finish writing everything (blocking), raising any error the writer thread ran into
+    def close(self):
+        self.chunks.put(None)
+        self.thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def runWriter(self):
+        pending = []
+        pendingSize = 0
+        done = False
+
+        try:
+            while True:
+                data = self.chunks.get()
+                if data is None:
+                    done = True
+                    break
+
+                pending.append(data)
+                pendingSize += len(data)
+
+                if pendingSize >= FileWriter.WRITE_SIZE:
+                    # Write whole blocks and hold on to the rest
+                    buffered = "".join(pending)
+                    cut = len(buffered) - len(buffered) % FileWriter.WRITE_SIZE
+                    self.outfile.write(buffered[:cut])
+                    self.written += cut
+                    pending = [buffered[cut:]]
+                    pendingSize = len(pending[0])
+
+            self.outfile.write("".join(pending))
+            self.written += pendingSize
+            self.outfile.flush()
+            self.truncateToWritten()
+            if self.sync:
+                os.fsync(self.outfile.fileno())
+        except (IOError, OSError) as e:
+            self.error = e
+
+            # Keep draining so the receiving thread never blocks on a full queue
+            while not done:
+                done = self.chunks.get() is None
+
+            try:
+                self.truncateToWritten()
+            except (IOError, OSError):
+                pass
+        finally:
+            self.outfile.close()
+
+    # The file was preallocated to the full size, so it has to be cut back if the transfer ended early
+    def truncateToWritten(self):
+        if self.written < self.size:
+            self.outfile.truncate(self.written)
+
+
 def printNetworkStats(time, rate):
     print "Network Stats:"
     print "Total time: " + str(time) + " seconds"
@@ -0,0 +1,220 @@
+"""
+Replays a capture recorded with RTPSocket.start_capture (or the fta "capture" command) and reports where the time
+went. This file should be run via command line with the following arguments:
+
+F: the capture file to replay
+
+
+Example: python rtp-replay.py F
+
+The datagrams the captured side received are fed through a fresh RTPSocketPipeline to reproduce its connection and
+receive window state. The datagrams it sent are matched against the ACKs it received to find window stalls and the
+cause of each retransmit.
+
+"""
+import socket
+import sys
+from RTPSocket import RTPPacket, RTPSocketPipeline
+from rtp_capture import read_capture, SENT, RECEIVED
+
+REPLAY_ADDR = ('replay', 0)
+
+
+# Stands in for the pipeline's clock, following the capture's timestamps so that its timers run as they did live
+class ReplayClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+# Stands in for the pipeline's UDP socket, handing it recorded datagrams and collecting what it sends back
+class ReplaySocket(object):
+    def __init__(self):
+        self.inbox = []
+        self.sent = []
+
+    def recvfrom(self, size):
+        if not self.inbox:
+            raise socket.timeout()
+        return self.inbox.pop(0), REPLAY_ADDR
+
+    def sendto(self, data, addr):
+        self.sent.append(data)
+
+    def settimeout(self, timeout):
+        pass
+
+    def close(self):
+        pass
+
+
+class ReplayReport(object):
+    def __init__(self):
+        self.first_time = None
+        self.last_time = None
+        self.connected_time = None
+        self.disconnect_time = None
+        self.counts = {SENT: 0, RECEIVED: 0}
+        self.bytes = {SENT: 0, RECEIVED: 0}
+        self.bad_checksums = 0
+        self.parity_packets = {SENT: 0, RECEIVED: 0}
+        self.delivered = 0
+        self.duplicates = 0
+
+        # Sender side bookkeeping
+        self.last_sent = {} # seq_num -> time it was last (re)transmitted
+        self.unacked = set()
+        self.highest_sent = 0
+        self.peer_window = None
+        self.last_ack_time = None
+        self.last_peer_time = None
+        self.highest_acked = 0
+        self.retransmits = {}
+        self.stall_start = None
+        self.stalls = []
+
+    def sent_packet(self, timestamp, pkt):
+        if pkt.is_parity:
+            self.parity_packets[SENT] += 1
+            return
+        if not pkt.has_non_ack_info() or pkt.seq_num == 0:
+            return
+
+        if pkt.seq_num in self.last_sent and pkt.seq_num in self.unacked:
+            cause = self._retransmit_cause(self.last_sent[pkt.seq_num], pkt.seq_num)
+            self.retransmits[cause] = self.retransmits.get(cause, 0) + 1
+
+        self.last_sent[pkt.seq_num] = timestamp
+        self.unacked.add(pkt.seq_num)
+        self.highest_sent = max(self.highest_sent, pkt.seq_num)
+        self._update_stall(timestamp)
+
+    def received_packet(self, timestamp, pkt):
+        self.last_peer_time = timestamp
+        self.peer_window = pkt.window_size
+
+        if pkt.is_parity:
+            self.parity_packets[RECEIVED] += 1
+        elif pkt.is_ack:
+            self.last_ack_time = timestamp
+            self.unacked.discard(pkt.ack_num)
+            self.highest_acked = max(self.highest_acked, pkt.ack_num)
+
+        self._update_stall(timestamp)
+
+    def _retransmit_cause(self, previous_send, seq_num):
+        if self.last_peer_time is None or self.last_peer_time < previous_send:
+            return 'timeout, nothing heard from peer'
+        if self.highest_acked > seq_num and self.last_ack_time >= previous_send:
+            return 'timeout, later packets ACKed (packet or its ACK lost)'
+        return 'timeout, peer alive but no later ACKs'
+
+    # The sender is stalled whenever the span of unacknowledged packets fills the peer's advertised window
+    def _update_stall(self, timestamp):
+        send_base = min(self.unacked) if self.unacked else self.highest_sent + 1
+        stalled = self.peer_window is not None and self.highest_sent + 1 - send_base >= self.peer_window
+
+        if stalled and self.stall_start is None:
+            self.stall_start = timestamp
+        elif not stalled and self.stall_start is not None:
+            self.stalls.append(timestamp - self.stall_start)
+            self.stall_start = None
+
+    def print_report(self):
+        if self.first_time is None:
+            print "Capture is empty"
+            return
+
+        end_of_transfer = self.disconnect_time or self.last_time
+
+        print "Capture:"
+        print "  Duration: " + str(self.last_time - self.first_time) + " seconds"
+        print "  Sent: " + str(self.counts[SENT]) + " datagrams, " + str(self.bytes[SENT]) + " bytes"
+        print "  Received: " + str(self.counts[RECEIVED]) + " datagrams, " + str(self.bytes[RECEIVED]) + " bytes"
+        print "  Bad checksums: " + str(self.bad_checksums)
+        print "  Parity packets sent/received: " + str(self.parity_packets[SENT]) + "/" + \
+              str(self.parity_packets[RECEIVED])
+
+        print "Phases:"
+        if self.connected_time is None:
+            print "  Handshake: never completed"
+        else:
+            print "  Handshake: " + str(self.connected_time - self.first_time) + " seconds"
+            print "  Transfer: " + str(end_of_transfer - self.connected_time) + " seconds"
+        if self.disconnect_time is not None:
+            print "  Teardown: " + str(self.last_time - self.disconnect_time) + " seconds"
+
+        print "Receive side (replayed):"
+        print "  Packets delivered in order: " + str(self.delivered)
+        print "  Duplicates re-ACKed: " + str(self.duplicates)
+
+        if self.stall_start is not None:
+            self.stalls.append(self.last_time - self.stall_start)
+
+        print "Send side:"
+        print "  Window stalls: " + str(len(self.stalls)) + ", " + str(sum(self.stalls)) + " seconds in total"
+        print "  Retransmits: " + str(sum(self.retransmits.values()))
+        for cause, count in sorted(self.retransmits.items()):
+            print "    " + cause + ": " + str(count)
+
+
+def replay(filename):
+    report = ReplayReport()
+    replay_clock = ReplayClock()
+    replay_sock = ReplaySocket()
+    pipeline = None
+    streams = set() # stream ids seen, to collect deliveries from
+
+    for timestamp, direction, data in read_capture(filename):
+        replay_clock.now = timestamp
+        if pipeline is None:
+            pipeline = RTPSocketPipeline(None, None, udp_sock=replay_sock, clock=replay_clock)
+            # Every recorded datagram comes from the one peer, whichever side of the handshake was captured
+            pipeline.update_client_info(*REPLAY_ADDR)
+
+        if report.first_time is None:
+            report.first_time = timestamp
+        report.last_time = timestamp
+        report.counts[direction] += 1
+        report.bytes[direction] += len(data)
+
+        pkt = RTPPacket.deserialize_and_create(data, REPLAY_ADDR)
+        if pkt is None:
+            report.bad_checksums += 1
+            continue
+
+        if pkt.is_disconnect and report.disconnect_time is None:
+            report.disconnect_time = timestamp
+
+        if direction == SENT:
+            report.sent_packet(timestamp, pkt)
+            continue
+
+        report.received_packet(timestamp, pkt)
+
+        # Step the pipeline's state machine with this datagram, letting it answer handshake packets
+        rcv_base = pipeline.rcv_base
+        replay_sock.inbox.append(data)
+        pipeline.step()
+
+        if pkt.has_non_ack_info() and not pkt.is_parity and pkt.seq_num < rcv_base:
+            report.duplicates += 1
+        if pkt.is_data():
+            streams.add(pkt.stream_id)
+        for stream in streams:
+            while pipeline.poll_packet(stream) is not None:
+                report.delivered += 1
+
+        if pipeline.connected and report.connected_time is None:
+            report.connected_time = timestamp
+
+    report.print_report()
+
+
+if len(sys.argv) != 2:
+    print "Please use following command: python rtp-replay.py <capture file>"
+    sys.exit(0)
+
+replay(sys.argv[1])
@@ -0,0 +1,297 @@
+"""
+Runs many RTP connections over a simulated network in virtual time, so that windowing and timer changes can be
+evaluated in seconds instead of hours. Each connection transfers a block of data from a client to a server over
+links with configurable loss and delay, and the run reports throughput, completion times and window dynamics.
+
+Nothing touches real sockets or sleeps: every RTPSocketPipeline gets a virtual clock and a simulated transport, and
+is stepped only when a datagram reaches it or one of its timers is due. Runs with the same options and seed are
+identical.
+
+
+Example: python rtp-simulate.py --connections 1000 --size 200000 --loss 0.02 --delay 0.05
+
+"""
+import argparse
+import random
+import socket
+import time
+from heapq import heappush, heappop
+from itertools import count
+from RTPSocket import RTPPacket, RTPSocketPipeline, split_data
+
+# How long a pipeline waits before being stepped again for timers or pacing. Mirrors the real transfer loop,
+# which wakes up at least this often
+STEP_INTERVAL = 0.001
+
+
+class VirtualClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+# Gilbert-Elliott loss: packets are dropped in bursts of mean_burst on average, for an overall loss rate of rate.
+# A mean_burst of 1 gives independent (Bernoulli) losses
+class LossModel(object):
+    def __init__(self, rng, rate, mean_burst):
+        self.rng = rng
+        self.bad = False
+        self.to_good = 1.0 / mean_burst
+        self.to_bad = rate / (mean_burst * (1 - rate)) if rate < 1 else 1.0
+
+    def drop(self):
+        if self.bad:
+            self.bad = self.rng.random() >= self.to_good
+        else:
+            self.bad = self.rng.random() < self.to_bad
+        return self.bad
+
+
+# One direction of a connection's path: base one-way delay plus uniform jitter (which can reorder packets)
+class Link(object):
+    def __init__(self, rng, options):
+        self.rng = rng
+        self.delay = options.delay
+        self.jitter = options.jitter
+        self.loss = LossModel(rng, options.loss, options.burst)
+
+    def transit_time(self):
+        return self.delay + self.rng.uniform(0, self.jitter)
+
+
+# Stands in for a pipeline's UDP socket, exchanging datagrams through the simulator
+class SimTransport(object):
+    def __init__(self, simulator, connection, addr, link):
+        self.simulator = simulator
+        self.connection = connection
+        self.addr = addr
+        self.link = link
+        self.pipeline = None
+        self.inbox = []
+        self.wake_time = None
+
+    def recvfrom(self, size):
+        if not self.inbox:
+            raise socket.timeout()
+        return self.inbox.pop(0)
+
+    def sendto(self, data, addr):
+        self.simulator.transmit(self, addr, data)
+
+    def settimeout(self, timeout):
+        pass
+
+    def close(self):
+        pass
+
+
+class Connection(object):
+    def __init__(self, simulator, connection_id, options):
+        self.connection_id = connection_id
+        self.size = options.size
+        self.start_time = None
+        self.completion_time = None
+        self.received_bytes = 0
+        self.sending = False
+        self.window_samples = [] # (time, receive window) whenever the server's window changes
+        self.client = self.make_transport(simulator, ('client', connection_id), options)
+        self.server = self.make_transport(simulator, ('server', connection_id), options)
+
+    def make_transport(self, simulator, addr, options):
+        transport = SimTransport(simulator, self, addr, Link(simulator.rng, options))
+        transport.pipeline = RTPSocketPipeline(None, None, udp_sock=transport, clock=simulator.clock)
+
+        pipeline = transport.pipeline
+        if options.window:
+            pipeline.set_window_size(options.window)
+        if options.rate:
+            pipeline.set_send_rate(options.rate)
+        pipeline.set_pacing(options.pace)
+        pipeline.set_fec(options.fec, options.adaptive_fec)
+        return transport
+
+    def is_done(self):
+        return self.completion_time is not None
+
+    def start(self, now):
+        self.start_time = now
+        self.client.pipeline.begin_connect(*self.server.addr)
+
+    # Like a real application, only send once connect() would have returned
+    def send(self):
+        self.sending = True
+        client = self.client.pipeline
+        for chunk in split_data('x' * self.size, client.max_payload_size()):
+            client.enqueue_packet_to_send(RTPPacket(chunk))
+
+    # Let the server's application read everything that has arrived, as fast as it arrives
+    def drain(self, now):
+        server = self.server.pipeline
+        pkt = server.poll_packet()
+        while pkt is not None:
+            self.received_bytes += len(pkt.payload)
+            pkt = server.poll_packet()
+
+        if not self.window_samples or self.window_samples[-1][1] != server.receive_window_size:
+            self.window_samples.append((now, server.receive_window_size))
+
+        if self.received_bytes >= self.size:
+            self.completion_time = now - self.start_time
+
+    # Time-weighted mean and maximum of the server's receive window over the transfer
+    def window_stats(self, end_time):
+        total = 0.0
+        for (start, window), (end, _) in zip(self.window_samples, self.window_samples[1:] + [(end_time, None)]):
+            total += window * (end - start)
+
+        duration = end_time - self.window_samples[0][0]
+        mean = total / duration if duration > 0 else self.window_samples[-1][1]
+        return mean, max(window for _, window in self.window_samples)
+
+
+class Simulator(object):
+    def __init__(self, options):
+        self.options = options
+        self.clock = VirtualClock()
+        self.rng = random.Random(options.seed)
+        self.events = []
+        self.event_order = count()
+        self.transports = {}
+        self.connections = []
+        self.datagrams = 0
+
+        for connection_id in range(options.connections):
+            connection = Connection(self, connection_id, options)
+            self.connections.append(connection)
+            self.transports[connection.client.addr] = connection.client
+            self.transports[connection.server.addr] = connection.server
+            self.schedule(self.rng.uniform(0, options.start_spread), self.start_connection, connection)
+
+    def schedule(self, at, action, *args):
+        heappush(self.events, (at, next(self.event_order), action, args))
+
+    def run(self):
+        remaining = len(self.connections)
+        while self.events and remaining:
+            at, _, action, args = heappop(self.events)
+            if at > self.options.time_limit:
+                break
+
+            self.clock.now = at
+            if action(*args):
+                remaining -= 1
+
+    def start_connection(self, connection):
+        connection.start(self.clock.now)
+        self.step(connection.client)
+
+    def transmit(self, transport, addr, data):
+        self.datagrams += 1
+        if not transport.link.loss.drop():
+            self.schedule(self.clock.now + transport.link.transit_time(), self.deliver, self.transports[addr], data,
+                          transport.addr)
+
+    def deliver(self, transport, data, src_addr):
+        transport.inbox.append((data, src_addr))
+        return self.step(transport)
+
+    def wake(self, transport, at):
+        # Superseded by an earlier wake up
+        if transport.wake_time != at:
+            return False
+
+        transport.wake_time = None
+        return self.step(transport)
+
+    # Run the pipeline until it has dealt with everything waiting for it, then arrange to be woken up for its timers.
+    # Returns True when this completes the connection's transfer
+    def step(self, transport):
+        connection = transport.connection
+        if connection.is_done():
+            return False
+
+        now = self.clock.now
+        pipeline = transport.pipeline
+        pipeline.step()
+
+        if transport is connection.client and pipeline.connected and not connection.sending:
+            connection.send()
+            pipeline.step()
+
+        if transport is connection.server:
+            connection.drain(now)
+            if connection.is_done():
+                return True
+
+        next_wake = pipeline.next_timer_due()
+        if next_wake is not None:
+            next_wake += STEP_INTERVAL
+
+        if next_wake is not None and (transport.wake_time is None or next_wake < transport.wake_time):
+            transport.wake_time = next_wake
+            self.schedule(next_wake, self.wake, transport, next_wake)
+
+        return False
+
+    def print_report(self, wall_time):
+        done = [connection for connection in self.connections if connection.is_done()]
+        end_time = self.clock.now
+
+        print "Simulated " + str(len(self.connections)) + " connections in " + str(end_time) + " virtual seconds (" + \
+              str(wall_time) + " seconds of real time)"
+        print "  Completed: " + str(len(done))
+        print "  Datagrams sent: " + str(self.datagrams)
+        print "  Retransmits: " + str(sum(connection.client.pipeline.resend_count for connection in self.connections))
+
+        if not done:
+            return
+
+        total_bytes = sum(connection.size for connection in done)
+        span = max(connection.start_time + connection.completion_time for connection in done) - \
+               min(connection.start_time for connection in done)
+        print "Throughput:"
+        print "  Aggregate: " + str(total_bytes / span) + " bytes per second"
+        print "  Per connection (mean): " + \
+              str(sum(connection.size / connection.completion_time for connection in done) / len(done)) + \
+              " bytes per second"
+
+        print "Completion time (seconds):"
+        print_distribution([connection.completion_time for connection in done])
+
+        window_stats = [connection.window_stats(connection.start_time + connection.completion_time)
+                        for connection in done]
+        print "Receive window, time-weighted mean (packets):"
+        print_distribution([mean for mean, _ in window_stats])
+        print "Receive window, maximum (packets):"
+        print_distribution([maximum for _, maximum in window_stats])
+
+
+def print_distribution(values):
+    values = sorted(values)
+    percentile = lambda p: values[min(len(values) - 1, int(p * len(values)))]
+    print "  min " + str(values[0]) + ", p50 " + str(percentile(0.5)) + ", p90 " + str(percentile(0.9)) + \
+          ", p99 " + str(percentile(0.99)) + ", max " + str(values[-1])
+
+
+parser = argparse.ArgumentParser(description="Simulate RTP connections in virtual time.")
+parser.add_argument("--connections", type=int, default=100, help="number of connections")
+parser.add_argument("--size", type=int, default=100000, help="bytes each connection transfers")
+parser.add_argument("--start-spread", type=float, default=1.0, help="connections start uniformly over this many seconds")
+parser.add_argument("--loss", type=float, default=0.01, help="fraction of datagrams lost on each link")
+parser.add_argument("--burst", type=float, default=1.0, help="mean length of a loss burst (1 for independent losses)")
+parser.add_argument("--delay", type=float, default=0.05, help="one-way delay in seconds")
+parser.add_argument("--jitter", type=float, default=0.0, help="extra uniformly random one-way delay in seconds")
+parser.add_argument("--window", type=int, default=0, help="fixed window size in packets (0 to auto-tune)")
+parser.add_argument("--rate", type=int, default=0, help="send rate cap in bytes per second (0 for none)")
+parser.add_argument("--pace", action="store_true", help="pace sends over the RTT")
+parser.add_argument("--fec", type=int, default=0, help="FEC group size (0 for none)")
+parser.add_argument("--adaptive-fec", action="store_true", help="adapt the FEC group size to the loss rate")
+parser.add_argument("--seed", type=int, default=1, help="random seed")
+parser.add_argument("--time-limit", type=float, default=3600, help="virtual seconds to give up after")
+
+simulator = Simulator(parser.parse_args())
+start = time.time()
+simulator.run()
+simulator.print_report(time.time() - start)
@@ -0,0 +1,84 @@
+import struct
+from Queue import Queue, Empty
+from threading import Thread
+from time import time
+
+# Capture file layout: the magic string, then one record per datagram. Each record is a big-endian
+# (timestamp: double, direction: 'S' or 'R', length: ushort) header followed by the raw datagram
+MAGIC = 'RTPCAP\x01\n'
+RECORD_FORMAT = '>dcH'
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_FORMAT)
+
+SENT = 'S'
+RECEIVED = 'R'
+
+
+# Records datagrams to a capture file. Recording only stamps the datagram and queues it, and a background thread
+# does the writing, so the transfer thread never waits on disk. Timestamps come from clock, which is the pipeline's
+class PacketCapture(object):
+    def __init__(self, filename, clock=time):
+        self._clock = clock
+        self._last_time = 0
+        self._records = Queue()
+        self._file = open(filename, 'wb')
+        self._file.write(MAGIC)
+
+        self._writer_thread = Thread(target=self._run_writer, name='CaptureThread')
+        self._writer_thread.daemon = True
+        self._writer_thread.start()
+
+    def record(self, direction, data):
+        # Never let the clock step backwards, so that timestamps are monotonic within a capture
+        self._last_time = max(self._clock(), self._last_time)
+        self._records.put((self._last_time, direction, data))
+
+    # Flush everything recorded so far and close the file (blocking)
+    def close(self):
+        self._records.put(None)
+        self._writer_thread.join()
+
+    def _run_writer(self):
+        running = True
+        while running:
+            # Write out everything that has queued up in one go
+            chunks = []
+            record = self._records.get()
+            while True:
+                if record is None:
+                    running = False
+                    break
+
+                timestamp, direction, data = record
+                chunks.append(struct.pack(RECORD_FORMAT, timestamp, direction, len(data)))
+                chunks.append(data)
+
+                try:
+                    record = self._records.get_nowait()
+                except Empty:
+                    break
+
+            self._file.write(''.join(chunks))
+
+        self._file.close()
+
+
+# Yields (timestamp, direction, datagram) for each record in a capture file
+def read_capture(filename):
+    infile = open(filename, 'rb')
+    try:
+        if infile.read(len(MAGIC)) != MAGIC:
+            raise ValueError(filename + ' is not an RTP capture file')
+
+        while True:
+            header = infile.read(RECORD_HEADER_SIZE)
+            if len(header) < RECORD_HEADER_SIZE:
+                break
+
+            timestamp, direction, length = struct.unpack(RECORD_FORMAT, header)
+            data = infile.read(length)
+            if len(data) < length:
+                break
+
+            yield timestamp, direction, data
+    finally:
+        infile.close()